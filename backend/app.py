@@ -1,17 +1,21 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Depends
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import PlainTextResponse
+from pydantic import BaseModel, Field
 import asyncio
 import json
 import secrets
 import string
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Set
 import logging
-from auth import AuthenticatedUser, verify_token, require_interviewer_role, require_candidate_role
+from auth import AuthenticatedUser, authenticate_token, verify_token, require_interviewer_role, require_candidate_role, require_admin_role
+from structured_logging import configure_logging, dropped_records, level_from_env, log_fields
+from presence import PresenceTracker, HEARTBEAT_INTERVAL, HEARTBEAT_SEND_TIMEOUT, WHEEL_TICK, presence_diff
+from profiling import Profiler
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Configure logging (queued, JSON, rate-capped per category)
+configure_logging(level=level_from_env())
 logger = logging.getLogger(__name__)
 
 app = FastAPI(title="Safe Interviews Backend", version="1.0.0")
@@ -28,6 +32,13 @@ app.add_middleware(
 # In-memory storage (replace with database in production)
 interview_rooms: Dict[str, dict] = {}
 active_connections: Dict[str, List[WebSocket]] = {}
+presence = PresenceTracker()
+heartbeat_task: Optional[asyncio.Task] = None
+heartbeat_jobs: Set[asyncio.Task] = set()
+
+# Seconds a new WebSocket has to send its auth frame
+WEBSOCKET_AUTH_TIMEOUT = 10.0
+profiler = Profiler()
 
 class CreateRoomRequest(BaseModel):
     pass  # User info will come from authentication
@@ -42,6 +53,11 @@ class EditorUpdate(BaseModel):
     user_name: str
     cursor_position: Optional[dict] = None
 
+class ProfilingRequest(BaseModel):
+    duration_seconds: float = Field(default=30.0, gt=0, le=600)
+    sample_interval_ms: float = Field(default=5.0, ge=1, le=1000)
+    slow_threshold_ms: float = Field(default=50.0, ge=0)
+
 def generate_room_code() -> str:
     """Generate a 6-digit alphanumeric room code"""
     return ''.join(secrets.choice(string.ascii_uppercase + string.digits) for _ in range(6))
@@ -73,7 +89,8 @@ async def create_room(request: CreateRoomRequest, interviewer: AuthenticatedUser
     
     active_connections[room_code] = []
     
-    logger.info(f"Room {room_code} created by interviewer {interviewer.name} ({interviewer.email})")
+    logger.info("Room %s created by interviewer %s (%s)", room_code, interviewer.name, interviewer.email,
+                extra=log_fields("room", room_code=room_code, user_id=interviewer.user_id))
     
     return {
         "room_code": room_code,
@@ -102,7 +119,8 @@ async def join_room(request: JoinRoomRequest, candidate: AuthenticatedUser = Dep
     }
     room["status"] = "active"
     
-    logger.info(f"Candidate {candidate.name} ({candidate.email}) joined room {room_code}")
+    logger.info("Candidate %s (%s) joined room %s", candidate.name, candidate.email, room_code,
+                extra=log_fields("room", room_code=room_code, user_id=candidate.user_id))
     
     return {
         "room_code": room_code,
@@ -129,9 +147,18 @@ async def get_room_info(room_code: str):
         "interviewer": room["interviewer"],
         "candidate": room["candidate"],
         "status": room["status"],
-        "editor_content": room["editor_content"]
+        "editor_content": room["editor_content"],
+        "participants": room["participants"]
     }
 
+def participant_role(room: dict, user_id: str) -> str:
+    """Derive a connection's role from the room for an authenticated user id"""
+    if room["interviewer"]["id"] == user_id:
+        return "interviewer"
+    if room["candidate"] and room["candidate"]["id"] == user_id:
+        return "candidate"
+    return "observer"
+
 @app.websocket("/ws/{room_code}")
 async def websocket_endpoint(websocket: WebSocket, room_code: str):
     """WebSocket endpoint for real-time collaboration"""
@@ -143,38 +170,64 @@ async def websocket_endpoint(websocket: WebSocket, room_code: str):
     
     await websocket.accept()
     
+    user = await authenticate_websocket(websocket)
+    if user is None:
+        try:
+            await websocket.close(code=4001, reason="Authentication failed")
+        except Exception:
+            pass
+        return
+    
     # Add connection to room
     if room_code not in active_connections:
         active_connections[room_code] = []
     active_connections[room_code].append(websocket)
     
+    # Add connection to the presence roster
+    room = interview_rooms[room_code]
+    entry = presence.join(room_code, websocket, user.user_id, user.name, participant_role(room, user.user_id))
+    room["participants"].append(entry)
+    ensure_heartbeat_running()
+    
     try:
         # Send current room state to new connection
-        room = interview_rooms[room_code]
         await websocket.send_text(json.dumps({
             "type": "room_state",
+            "connection_id": entry["connection_id"],
             "room_info": {
                 "interviewer": room["interviewer"],
                 "candidate": room["candidate"],
                 "status": room["status"],
-                "editor_content": room["editor_content"]
+                "editor_content": room["editor_content"],
+                "participants": room["participants"]
             }
         }))
         
         # Notify other participants about new connection
-        await broadcast_to_room(room_code, {
-            "type": "participant_joined",
-            "timestamp": datetime.utcnow().isoformat()
-        }, exclude_websocket=websocket)
+        await broadcast_to_room(room_code, presence_diff(added=[entry]), exclude_websocket=websocket)
         
         # Listen for messages
         while True:
             data = await websocket.receive_text()
+            timer = profiler.timer(room_code)
             message = json.loads(data)
+            message_type = message.get("type")
+            timer.mark(message_type, "parse")
+            
+            # Any inbound traffic proves the socket is alive
+            presence.touch(websocket)
             
-            if message["type"] == "editor_update":
+            if message["type"] == "pong":
+                changed = presence.pong(websocket, message.get("seq"))
+                timer.mark(message_type, "state")
+                if changed:
+                    await broadcast_to_room(changed[0], presence_diff(updated=[changed[1]]))
+                    timer.mark(message_type, "broadcast")
+                
+            elif message["type"] == "editor_update":
                 # Update room content
                 room["editor_content"] = message["content"]
+                timer.mark(message_type, "state")
                 
                 # Broadcast to all other connections in the room
                 await broadcast_to_room(room_code, {
@@ -185,6 +238,7 @@ async def websocket_endpoint(websocket: WebSocket, room_code: str):
                     "cursor_position": message.get("cursor_position"),
                     "timestamp": datetime.utcnow().isoformat()
                 }, exclude_websocket=websocket)
+                timer.mark(message_type, "broadcast")
                 
             elif message["type"] == "cursor_update":
                 # Broadcast cursor position to other participants
@@ -195,6 +249,7 @@ async def websocket_endpoint(websocket: WebSocket, room_code: str):
                     "cursor_position": message.get("cursor_position"),
                     "timestamp": datetime.utcnow().isoformat()
                 }, exclude_websocket=websocket)
+                timer.mark(message_type, "broadcast")
                 
             elif message["type"] == "window_focus_lost":
                 # Record window focus incident for candidates only
@@ -206,6 +261,7 @@ async def websocket_endpoint(websocket: WebSocket, room_code: str):
                     "duration": message.get("duration", 0)
                 }
                 room["monitoring_incidents"].append(incident)
+                timer.mark(message_type, "state")
                 
                 # Notify interviewer about the incident
                 await broadcast_to_room(room_code, {
@@ -217,8 +273,12 @@ async def websocket_endpoint(websocket: WebSocket, room_code: str):
                     "duration": message.get("duration", 0),
                     "message": f"Candidate {message.get('user_name')} lost window focus"
                 }, exclude_websocket=websocket)
+                timer.mark(message_type, "broadcast")
                 
-                logger.info(f"Window focus lost incident recorded for candidate {message.get('user_name')} in room {room_code}")
+                logger.info("Window focus lost incident recorded for candidate %s in room %s",
+                            user.name, room_code,
+                            extra=log_fields("monitoring", room_code=room_code,
+                                             user_id=user.user_id, message_type=message["type"]))
                 
             elif message["type"] == "keystroke_monitoring":
                 # Record keystroke data for candidates only
@@ -231,6 +291,7 @@ async def websocket_endpoint(websocket: WebSocket, room_code: str):
                     "is_suspicious": message.get("is_suspicious", False)
                 }
                 room["keystroke_logs"].append(keystroke_data)
+                timer.mark(message_type, "state")
                 
                 # If it's a suspicious key combination, alert the interviewer
                 if message.get("is_suspicious", False):
@@ -243,52 +304,151 @@ async def websocket_endpoint(websocket: WebSocket, room_code: str):
                         "key_combination": message.get("key_combination"),
                         "message": f"Candidate {message.get('user_name')} used suspicious key combination: {message.get('key_combination')}"
                     }, exclude_websocket=websocket)
+                    timer.mark(message_type, "broadcast")
                     
-                    logger.info(f"Suspicious keystroke recorded for candidate {message.get('user_name')} in room {room_code}: {message.get('key_combination')}")
+                    logger.info("Suspicious keystroke recorded for candidate %s in room %s: %s",
+                                user.name, room_code, message.get("key_combination"),
+                                extra=log_fields("monitoring", room_code=room_code,
+                                                 user_id=user.user_id, message_type=message["type"]))
                 
     except WebSocketDisconnect:
-        logger.info(f"WebSocket disconnected from room {room_code}")
+        logger.info("WebSocket disconnected from room %s", room_code,
+                    extra=log_fields("connection", room_code=room_code, user_id=user.user_id))
     except Exception as e:
-        logger.error(f"WebSocket error in room {room_code}: {e}")
+        logger.error("WebSocket error in room %s: %s", room_code, e,
+                     extra=log_fields("connection", room_code=room_code, user_id=user.user_id))
     finally:
-        # Remove connection
-        if room_code in active_connections:
-            try:
-                active_connections[room_code].remove(websocket)
-                if not active_connections[room_code]:
-                    del active_connections[room_code]
-            except ValueError:
-                pass
-        
-        # Notify remaining participants
-        await broadcast_to_room(room_code, {
-            "type": "participant_left",
-            "timestamp": datetime.utcnow().isoformat()
-        })
+        # Remove connection and notify remaining participants
+        await drop_connection(room_code, websocket)
+
+async def authenticate_websocket(websocket: WebSocket) -> Optional[AuthenticatedUser]:
+    """Authenticate from the first frame, which must be {"type": "auth", "token": <jwt>}.
+
+    The token travels inside the socket rather than in the URL so it never
+    appears in server access logs. Returns None if the frame is missing,
+    malformed or late, or the token is invalid.
+    """
+    try:
+        data = await asyncio.wait_for(websocket.receive_text(), WEBSOCKET_AUTH_TIMEOUT)
+        message = json.loads(data)
+        if not isinstance(message, dict) or message.get("type") != "auth" or not message.get("token"):
+            return None
+        return await authenticate_token(message["token"])
+    except (asyncio.TimeoutError, ValueError, HTTPException, WebSocketDisconnect):
+        return None
+
+async def drop_connection(room_code: str, websocket: WebSocket):
+    """Remove a connection from its room and roster, announcing the departure once"""
+    if room_code in active_connections:
+        try:
+            active_connections[room_code].remove(websocket)
+            if not active_connections[room_code]:
+                del active_connections[room_code]
+        except ValueError:
+            pass
+    
+    departed = presence.leave(websocket)
+    if departed is None:
+        return
+    
+    _, entry = departed
+    room = interview_rooms.get(room_code)
+    if room is not None and entry in room["participants"]:
+        room["participants"].remove(entry)
+    
+    await broadcast_to_room(room_code, presence_diff(removed=[entry["connection_id"]]))
+
+def ensure_heartbeat_running():
+    """Start the heartbeat task on the running event loop if it is not already active"""
+    global heartbeat_task
+    loop = asyncio.get_running_loop()
+    if heartbeat_task is None or heartbeat_task.done() or heartbeat_task.get_loop() is not loop:
+        heartbeat_task = loop.create_task(heartbeat_loop())
+
+def spawn_heartbeat_job(coroutine):
+    """Run heartbeat network I/O in its own task so a stalled peer never delays a tick"""
+    task = asyncio.get_running_loop().create_task(coroutine)
+    heartbeat_jobs.add(task)
+    task.add_done_callback(heartbeat_jobs.discard)
+
+async def heartbeat_loop():
+    """Advance the presence timer wheel, reap dead sockets and send pings.
+
+    The tick itself never awaits a peer; sends and closes run as separate
+    jobs. Runs while any connection is tracked and exits once the roster is empty.
+    """
+    ticks_per_ping = max(1, round(HEARTBEAT_INTERVAL / WHEEL_TICK))
+    tick = 0
+    while len(presence):
+        await asyncio.sleep(WHEEL_TICK)
+        tick += 1
+        try:
+            for websocket in presence.expire():
+                spawn_heartbeat_job(reap_connection(websocket))
+            if tick % ticks_per_ping == 0:
+                spawn_heartbeat_job(send_heartbeat())
+        except Exception as e:
+            logger.error("Heartbeat tick failed: %s", e, extra=log_fields("connection"))
+
+async def send_heartbeat():
+    """Ping every tracked socket and broadcast quality changes from missed pongs"""
+    seq, updates = presence.next_ping()
+    ping = json.dumps({"type": "ping", "seq": seq, "timestamp": datetime.utcnow().isoformat()})
+    
+    sockets = presence.sockets()
+    results = await asyncio.gather(*(send_bounded(websocket, ping) for websocket in sockets), return_exceptions=True)
+    for websocket, result in zip(sockets, results):
+        if isinstance(result, Exception):
+            await reap_connection(websocket)
+    
+    for room_code, room_updates in updates.items():
+        await broadcast_to_room(room_code, presence_diff(updated=room_updates))
+
+async def reap_connection(websocket: WebSocket, room_code: Optional[str] = None):
+    """Close an unresponsive socket and drop it from its room.
+
+    ``room_code`` lets callers reap sockets the roster no longer tracks.
+    """
+    tracked = presence.get(websocket)
+    if tracked is not None:
+        room_code, entry = tracked
+        logger.info("Reaping unresponsive connection %s in room %s", entry["connection_id"], room_code,
+                    extra=log_fields("connection", room_code=room_code, user_id=entry["user_id"]))
+    if room_code is None:
+        return
+    
+    await drop_connection(room_code, websocket)
+    try:
+        await asyncio.wait_for(websocket.close(code=4008, reason="Heartbeat timeout"), HEARTBEAT_SEND_TIMEOUT)
+    except Exception:
+        pass
+
+async def send_bounded(websocket: WebSocket, text: str):
+    """Send to one socket, giving up after HEARTBEAT_SEND_TIMEOUT (a peer that stopped reading)"""
+    await asyncio.wait_for(websocket.send_text(text), HEARTBEAT_SEND_TIMEOUT)
 
 async def broadcast_to_room(room_code: str, message: dict, exclude_websocket: WebSocket = None):
     """Broadcast a message to all connections in a room"""
     if room_code not in active_connections:
         return
     
-    disconnected_connections = []
+    text = json.dumps(message)
+    connections = [connection for connection in active_connections[room_code] if connection != exclude_websocket]
     
-    for connection in active_connections[room_code]:
-        if connection == exclude_websocket:
-            continue
-            
-        try:
-            await connection.send_text(json.dumps(message))
-        except Exception as e:
-            logger.error(f"Failed to send message to connection: {e}")
+    # Send concurrently with a time limit so one stalled peer cannot hold up the room
+    results = await asyncio.gather(*(send_bounded(connection, text) for connection in connections),
+                                   return_exceptions=True)
+    
+    disconnected_connections = []
+    for connection, result in zip(connections, results):
+        if isinstance(result, Exception):
+            logger.error("Failed to send message to connection in room %s: %r", room_code, result,
+                         extra=log_fields("connection", room_code=room_code, message_type=message.get("type")))
             disconnected_connections.append(connection)
     
-    # Remove disconnected connections
+    # Close and remove failed or stalled connections so their handlers end too
     for connection in disconnected_connections:
-        try:
-            active_connections[room_code].remove(connection)
-        except ValueError:
-            pass
+        await reap_connection(connection, room_code)
 
 @app.delete("/api/room/{room_code}")
 async def close_room(room_code: str):
@@ -317,7 +477,7 @@ async def close_room(room_code: str):
     # Remove room
     del interview_rooms[room_code]
     
-    logger.info(f"Room {room_code} closed")
+    logger.info("Room %s closed", room_code, extra=log_fields("room", room_code=room_code))
     
     return {"status": "success", "message": "Room closed successfully"}
 
@@ -343,13 +503,52 @@ async def get_monitoring_data(room_code: str, interviewer: AuthenticatedUser = D
         "total_keystrokes": len(room["keystroke_logs"])
     }
 
+@app.post("/api/admin/profiling")
+async def start_profiling(request: ProfilingRequest, admin: AuthenticatedUser = Depends(require_admin_role)):
+    """Open a time-boxed profiling window on the event loop (admin only)"""
+    try:
+        # Runs on the event loop thread, so that is the thread being sampled
+        profiler.start(
+            duration=request.duration_seconds,
+            sample_interval=request.sample_interval_ms / 1000.0,
+            slow_threshold=request.slow_threshold_ms / 1000.0
+        )
+    except RuntimeError:
+        raise HTTPException(status_code=409, detail="Profiling is already running")
+    
+    logger.info("Profiling started by %s for %.1fs", admin.email, request.duration_seconds,
+                extra=log_fields("admin", user_id=admin.user_id))
+    
+    return {"status": "success", "started_at": profiler.started_at, "ends_at": profiler.ends_at}
+
+@app.delete("/api/admin/profiling")
+async def stop_profiling(admin: AuthenticatedUser = Depends(require_admin_role)):
+    """Close the profiling window early (admin only)"""
+    profiler.stop()
+    logger.info("Profiling stopped by %s", admin.email, extra=log_fields("admin", user_id=admin.user_id))
+    return {"status": "success", "message": "Profiling stopped"}
+
+@app.get("/api/admin/profiling")
+async def get_profiling_report(admin: AuthenticatedUser = Depends(require_admin_role)):
+    """Per-message-type handler timings and slow awaits for the latest window (admin only)"""
+    return profiler.report()
+
+@app.get("/api/admin/profiling/flamegraph")
+async def download_flamegraph(admin: AuthenticatedUser = Depends(require_admin_role)):
+    """Download sampled event loop stacks in collapsed format (admin only)"""
+    return PlainTextResponse(
+        profiler.folded_stacks(),
+        headers={"Content-Disposition": 'attachment; filename="event-loop.folded"'}
+    )
+
 @app.get("/api/health")
 async def health_check():
     """Health check endpoint"""
     return {
         "status": "healthy",
         "active_rooms": len(interview_rooms),
-        "active_connections": sum(len(connections) for connections in active_connections.values())
+        "active_connections": sum(len(connections) for connections in active_connections.values()),
+        "log_records_dropped": dropped_records()
     }
 
 if __name__ == "__main__":
@@ -17,6 +17,9 @@ SUPABASE_URL = os.getenv("SUPABASE_URL", "")
 SUPABASE_ANON_KEY = os.getenv("SUPABASE_ANON_KEY", "")
 SUPABASE_JWT_SECRET = os.getenv("SUPABASE_JWT_SECRET", "")
 
+# Comma-separated list of emails allowed to use admin endpoints
+ADMIN_EMAILS = {email.strip().lower() for email in os.getenv("ADMIN_EMAILS", "").split(",") if email.strip()}
+
 # Initialize Supabase client
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_ANON_KEY) if SUPABASE_URL and SUPABASE_ANON_KEY else None
 
@@ -24,16 +27,21 @@ supabase: Client = create_client(SUPABASE_URL, SUPABASE_ANON_KEY) if SUPABASE_UR
 security = HTTPBearer()
 
 class AuthenticatedUser:
-    def __init__(self, user_id: str, email: str, user_metadata: Dict[str, Any]):
+    def __init__(self, user_id: str, email: str, user_metadata: Dict[str, Any],
+                 app_metadata: Optional[Dict[str, Any]] = None):
         self.user_id = user_id
         self.email = email
         self.user_metadata = user_metadata
+        # Only the service role can write app_metadata; user_metadata is user-editable
+        self.app_metadata = app_metadata or {}
         self.name = user_metadata.get("name", email.split("@")[0])
 
 async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)) -> AuthenticatedUser:
     """Verify Supabase JWT token and return user information"""
-    token = credentials.credentials
-    
+    return await authenticate_token(credentials.credentials)
+
+async def authenticate_token(token: str) -> AuthenticatedUser:
+    """Verify a raw Supabase JWT (e.g. from a WebSocket query string) and return the user"""
     try:
         if not SUPABASE_JWT_SECRET:
             # For development/testing - skip token verification
@@ -55,6 +63,7 @@ async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(secur
         user_id = payload.get("sub")
         email = payload.get("email")
         user_metadata = payload.get("user_metadata", {})
+        app_metadata = payload.get("app_metadata", {})
         
         if not user_id or not email:
             raise HTTPException(
@@ -62,7 +71,7 @@ async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(secur
                 detail="Invalid token: missing user information"
             )
         
-        return AuthenticatedUser(user_id, email, user_metadata)
+        return AuthenticatedUser(user_id, email, user_metadata, app_metadata)
         
     except jwt.ExpiredSignatureError:
         raise HTTPException(
@@ -102,4 +111,13 @@ def require_candidate_role(user: AuthenticatedUser = Depends(verify_token)) -> A
     """Ensure the user has candidate role (for now, all authenticated users can be candidates)"""
     # In a real implementation, you might check user roles from the database
     # For now, any authenticated user can be a candidate
-    return user 
\ No newline at end of file
+    return user
+
+def require_admin_role(user: AuthenticatedUser = Depends(verify_token)) -> AuthenticatedUser:
+    """Ensure the user is an administrator (listed in ADMIN_EMAILS or with app_metadata role "admin")"""
+    if user.email.lower() in ADMIN_EMAILS or user.app_metadata.get("role") == "admin":
+        return user
+    raise HTTPException(
+        status_code=status.HTTP_403_FORBIDDEN,
+        detail="Admin privileges required"
+    )
@@ -0,0 +1,219 @@
+"""
+Heartbeat-driven presence tracking for interview rooms.
+
+A single hashed timer wheel holds every connection's liveness deadline, so
+the heartbeat task does O(1) work per tick instead of keeping one timer per
+socket. Any inbound message or pong pushes the deadline forward; whatever is
+left in the slot under the cursor when it advances is considered dead.
+"""
+import math
+import secrets
+import time
+from datetime import datetime
+from typing import Any, Dict, Hashable, List, Optional, Set, Tuple
+
+HEARTBEAT_INTERVAL = 10.0  # seconds between server pings
+HEARTBEAT_TIMEOUT = 30.0   # silence after which a socket is reaped
+WHEEL_TICK = 1.0           # timer wheel resolution
+HEARTBEAT_SEND_TIMEOUT = 5.0  # a send or close slower than this marks the peer dead
+
+# Round-trip thresholds (ms) for connection quality
+GOOD_RTT_MS = 150.0
+FAIR_RTT_MS = 500.0
+RTT_SMOOTHING = 0.3
+
+class TimerWheel:
+    """Hashed timer wheel keyed by arbitrary hashable objects"""
+
+    def __init__(self, tick: float, horizon: float):
+        self.tick = tick
+        self.size = int(math.ceil(horizon / tick)) + 3
+        self.slots: List[Set[Hashable]] = [set() for _ in range(self.size)]
+        self.cursor = 0
+        self._slot_of: Dict[Hashable, int] = {}
+
+    def schedule(self, key: Hashable, delay: float) -> None:
+        """(Re)schedule ``key`` to expire no sooner than ``delay`` seconds from now.
+
+        The current tick is already partly elapsed, so one extra tick is added;
+        expiry lands between ``delay`` and ``delay + tick`` seconds later.
+        """
+        ticks = max(1, int(math.ceil(delay / self.tick))) + 1
+        if ticks >= self.size:
+            raise ValueError("delay exceeds timer wheel horizon")
+        self.cancel(key)
+        index = (self.cursor + ticks) % self.size
+        self.slots[index].add(key)
+        self._slot_of[key] = index
+
+    def cancel(self, key: Hashable) -> None:
+        index = self._slot_of.pop(key, None)
+        if index is not None:
+            self.slots[index].discard(key)
+
+    def advance(self) -> Set[Hashable]:
+        """Move the cursor one tick forward and return the keys that expired"""
+        self.cursor = (self.cursor + 1) % self.size
+        expired = self.slots[self.cursor]
+        self.slots[self.cursor] = set()
+        for key in expired:
+            del self._slot_of[key]
+        return expired
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._slot_of
+
+    def __len__(self) -> int:
+        return len(self._slot_of)
+
+def connection_quality(rtt_ms: Optional[float], missed_pings: int) -> str:
+    """Classify a connection from its smoothed RTT and missed heartbeats"""
+    if missed_pings >= 2:
+        return "poor"
+    if rtt_ms is None:
+        return "good" if missed_pings == 0 else "fair"
+    if missed_pings == 0 and rtt_ms < GOOD_RTT_MS:
+        return "good"
+    if rtt_ms < FAIR_RTT_MS:
+        return "fair"
+    return "poor"
+
+class _Connection:
+    __slots__ = ("room_code", "entry", "pending_seq", "ping_sent", "missed_pings")
+
+    def __init__(self, room_code: str, entry: Dict[str, Any]):
+        self.room_code = room_code
+        self.entry = entry
+        self.pending_seq: Optional[int] = None
+        self.ping_sent = 0.0
+        self.missed_pings = 0
+
+class PresenceTracker:
+    """Per-connection presence roster with heartbeat bookkeeping.
+
+    The tracker is transport-agnostic: callers send pings, close sockets and
+    broadcast the diffs it returns.
+    """
+
+    def __init__(self, timeout: float = HEARTBEAT_TIMEOUT, tick: float = WHEEL_TICK, clock=time.monotonic):
+        self.timeout = timeout
+        self.clock = clock
+        self.wheel = TimerWheel(tick, timeout)
+        self._connections: Dict[Hashable, _Connection] = {}
+        self._seq = 0
+
+    def join(self, room_code: str, websocket: Hashable, user_id: Optional[str],
+             user_name: Optional[str], role: str) -> Dict[str, Any]:
+        """Register a connection and return its roster entry"""
+        now = datetime.utcnow().isoformat()
+        entry = {
+            "connection_id": secrets.token_hex(4),
+            "user_id": user_id,
+            "user_name": user_name,
+            "role": role,
+            "connected_at": now,
+            "last_seen": now,
+            "rtt_ms": None,
+            "quality": "good",
+        }
+        self._connections[websocket] = _Connection(room_code, entry)
+        self.wheel.schedule(websocket, self.timeout)
+        return entry
+
+    def leave(self, websocket: Hashable) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """Forget a connection; returns ``(room_code, entry)`` the first time only"""
+        connection = self._connections.pop(websocket, None)
+        if connection is None:
+            return None
+        self.wheel.cancel(websocket)
+        return connection.room_code, connection.entry
+
+    def get(self, websocket: Hashable) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """Return ``(room_code, entry)`` for a tracked connection"""
+        connection = self._connections.get(websocket)
+        if connection is None:
+            return None
+        return connection.room_code, connection.entry
+
+    def touch(self, websocket: Hashable) -> None:
+        """Record activity on a connection, pushing its deadline forward"""
+        connection = self._connections.get(websocket)
+        if connection is None:
+            return
+        connection.entry["last_seen"] = datetime.utcnow().isoformat()
+        self.wheel.schedule(websocket, self.timeout)
+
+    def next_ping(self) -> Tuple[int, Dict[str, List[Dict[str, Any]]]]:
+        """Start a heartbeat round.
+
+        Returns the ping sequence number and, per room, the quality updates
+        caused by connections that never answered the previous ping.
+        """
+        self._seq += 1
+        now = self.clock()
+        updates: Dict[str, List[Dict[str, Any]]] = {}
+        for connection in self._connections.values():
+            if connection.pending_seq is not None:
+                connection.missed_pings += 1
+            connection.pending_seq = self._seq
+            connection.ping_sent = now
+            update = self._refresh_quality(connection)
+            if update:
+                updates.setdefault(connection.room_code, []).append(update)
+        return self._seq, updates
+
+    def pong(self, websocket: Hashable, seq: Any) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """Handle a pong; returns ``(room_code, update)`` if quality changed.
+
+        Callers are expected to ``touch`` the socket for every inbound message,
+        pongs included.
+        """
+        connection = self._connections.get(websocket)
+        if connection is None:
+            return None
+        if seq != connection.pending_seq:
+            return None
+
+        rtt_ms = (self.clock() - connection.ping_sent) * 1000.0
+        previous = connection.entry["rtt_ms"]
+        smoothed = rtt_ms if previous is None else previous + RTT_SMOOTHING * (rtt_ms - previous)
+        connection.entry["rtt_ms"] = round(smoothed, 1)
+        connection.pending_seq = None
+        connection.missed_pings = 0
+
+        update = self._refresh_quality(connection)
+        return (connection.room_code, update) if update else None
+
+    def expire(self) -> List[Hashable]:
+        """Advance the timer wheel one tick and return the sockets to reap"""
+        return [websocket for websocket in self.wheel.advance() if websocket in self._connections]
+
+    def sockets(self) -> List[Hashable]:
+        return list(self._connections)
+
+    def __len__(self) -> int:
+        return len(self._connections)
+
+    def _refresh_quality(self, connection: _Connection) -> Optional[Dict[str, Any]]:
+        quality = connection_quality(connection.entry["rtt_ms"], connection.missed_pings)
+        if quality == connection.entry["quality"]:
+            return None
+        connection.entry["quality"] = quality
+        return {
+            "connection_id": connection.entry["connection_id"],
+            "quality": quality,
+            "rtt_ms": connection.entry["rtt_ms"],
+        }
+
+def presence_diff(added: Optional[List[Dict[str, Any]]] = None,
+                  updated: Optional[List[Dict[str, Any]]] = None,
+                  removed: Optional[List[str]] = None) -> Dict[str, Any]:
+    """Build a ``presence_diff`` message containing only the non-empty parts"""
+    message: Dict[str, Any] = {"type": "presence_diff", "timestamp": datetime.utcnow().isoformat()}
+    if added:
+        message["added"] = added
+    if updated:
+        message["updated"] = updated
+    if removed:
+        message["removed"] = removed
+    return message
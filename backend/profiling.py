@@ -0,0 +1,181 @@
+"""
+On-demand profiling for the WebSocket hot path.
+
+While a profiling window is open, a background thread samples the event loop
+thread's stack into collapsed (flamegraph-compatible) form, and WebSocket
+handlers report per-message-type phase timings. Phases slower than the
+configured threshold are kept as slow-await records. Outside a window the
+handlers only pay for one attribute check per message.
+"""
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime, timedelta
+from typing import Any, Deque, Dict, Optional, Tuple
+
+MAX_SLOW_RECORDS = 500
+
+class _NullTimer:
+    """Timer handed out while profiling is off; every call is a no-op"""
+
+    __slots__ = ()
+
+    def mark(self, message_type: Optional[str], phase: str) -> None:
+        pass
+
+NULL_TIMER = _NullTimer()
+
+class _PhaseTimer:
+    """Measures consecutive handler phases for a single inbound message"""
+
+    __slots__ = ("profiler", "room_code", "last")
+
+    def __init__(self, profiler: "Profiler", room_code: str):
+        self.profiler = profiler
+        self.room_code = room_code
+        self.last = time.perf_counter()
+
+    def mark(self, message_type: Optional[str], phase: str) -> None:
+        """Close the current phase, attributing its duration to ``message_type``"""
+        now = time.perf_counter()
+        self.profiler.record(self.room_code, message_type or "unknown", phase, now - self.last)
+        self.last = now
+
+def _collapse(frame) -> str:
+    """Render a frame stack root-first in collapsed ``a;b;c`` form"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}".replace(" ", "_").replace(";", "_"))
+        frame = frame.f_back
+    names.reverse()
+    return ";".join(names)
+
+class Profiler:
+    """A single, time-boxed profiling window shared by the whole process"""
+
+    def __init__(self):
+        self.active = False
+        self.started_at: Optional[str] = None
+        self.ends_at: Optional[str] = None
+        self.sample_interval = 0.0
+        self.slow_threshold = 0.0
+        self.samples = 0
+        self._stacks: Counter = Counter()
+        self._phases: Dict[Tuple[str, str], list] = {}
+        self._slow: Deque[Dict[str, Any]] = deque(maxlen=MAX_SLOW_RECORDS)
+        self._lock = threading.Lock()
+        self._stop: Optional[threading.Event] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self, duration: float, sample_interval: float, slow_threshold: float,
+              thread_id: Optional[int] = None) -> None:
+        """Open a profiling window sampling ``thread_id`` (default: the caller's thread).
+
+        Call this from the event loop thread so that thread is the one sampled.
+        """
+        if self.active:
+            raise RuntimeError("profiling is already running")
+
+        now = datetime.utcnow()
+        self.started_at = now.isoformat()
+        self.ends_at = (now + timedelta(seconds=duration)).isoformat()
+        self.sample_interval = sample_interval
+        self.slow_threshold = slow_threshold
+        self.samples = 0
+        with self._lock:
+            self._stacks = Counter()
+        self._phases = {}
+        self._slow = deque(maxlen=MAX_SLOW_RECORDS)
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._sample,
+            args=(thread_id or threading.get_ident(), sample_interval, time.monotonic() + duration, self._stop),
+            name="event-loop-sampler",
+            daemon=True,
+        )
+        self.active = True
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Close the window early; collected results remain available"""
+        self.active = False
+        if self._stop is not None:
+            self._stop.set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Block until the sampler thread finishes; returns False on timeout"""
+        thread = self._thread
+        if thread is None:
+            return True
+        thread.join(timeout)
+        return not thread.is_alive()
+
+    def timer(self, room_code: str):
+        """Return a phase timer for one inbound message (no-op when inactive)"""
+        if not self.active:
+            return NULL_TIMER
+        return _PhaseTimer(self, room_code)
+
+    def record(self, room_code: str, message_type: str, phase: str, seconds: float) -> None:
+        stats = self._phases.get((message_type, phase))
+        if stats is None:
+            # [count, total seconds, max seconds]
+            stats = self._phases[(message_type, phase)] = [0, 0.0, 0.0]
+        stats[0] += 1
+        stats[1] += seconds
+        if seconds > stats[2]:
+            stats[2] = seconds
+
+        if seconds >= self.slow_threshold:
+            self._slow.append({
+                "room_code": room_code,
+                "message_type": message_type,
+                "phase": phase,
+                "duration_ms": round(seconds * 1000.0, 3),
+                "timestamp": datetime.utcnow().isoformat(),
+            })
+
+    def report(self) -> Dict[str, Any]:
+        """Summarise the current or most recent profiling window"""
+        handlers: Dict[str, Dict[str, Any]] = {}
+        for (message_type, phase), (count, total, maximum) in sorted(self._phases.items()):
+            handlers.setdefault(message_type, {})[phase] = {
+                "count": count,
+                "mean_ms": round(total / count * 1000.0, 3),
+                "max_ms": round(maximum * 1000.0, 3),
+                "total_ms": round(total * 1000.0, 3),
+            }
+
+        return {
+            "active": self.active,
+            "started_at": self.started_at,
+            "ends_at": self.ends_at,
+            "sample_interval_ms": self.sample_interval * 1000.0,
+            "slow_threshold_ms": self.slow_threshold * 1000.0,
+            "samples": self.samples,
+            "handlers": handlers,
+            "slow_awaits": sorted(self._slow, key=lambda record: record["duration_ms"], reverse=True),
+        }
+
+    def folded_stacks(self) -> str:
+        """Sampled stacks in Brendan Gregg's collapsed format (``stack count`` per line)"""
+        with self._lock:
+            stacks = list(self._stacks.items())
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(stacks))
+
+    def _sample(self, thread_id: int, interval: float, deadline: float, stop: threading.Event) -> None:
+        while not stop.wait(interval) and time.monotonic() < deadline:
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                break
+            stack = _collapse(frame)
+            del frame
+            with self._lock:
+                self._stacks[stack] += 1
+            self.samples += 1
+        if self._stop is stop:
+            self.active = False
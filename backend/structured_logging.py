@@ -0,0 +1,183 @@
+"""
+Queue-based structured logging for the Safe Interviews backend.
+
+Records are enqueued on the event loop and formatted/written by a background
+listener thread, so a slow stdout/pipe never stalls a WebSocket handler.
+"""
+import atexit
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Dict, Optional, Tuple
+
+# Structured fields copied from ``extra=`` onto the JSON record
+STRUCTURED_FIELDS = ("room_code", "user_id", "message_type", "category", "suppressed", "queue_dropped")
+
+# Per-category rate caps: (records per second, burst size).
+# Records without a category are never sampled.
+DEFAULT_CATEGORY_LIMITS: Dict[str, Tuple[float, int]] = {
+    "room": (50.0, 100),
+    "connection": (20.0, 50),
+    "monitoring": (10.0, 30),
+    "admin": (5.0, 20),
+}
+
+DEFAULT_QUEUE_SIZE = 10000
+
+def log_fields(category: str, room_code: Optional[str] = None, user_id: Optional[str] = None,
+               message_type: Optional[str] = None) -> Dict[str, Any]:
+    """Build the ``extra`` dict for a structured log call"""
+    return {
+        "category": category,
+        "room_code": room_code,
+        "user_id": user_id,
+        "message_type": message_type,
+    }
+
+class JsonFormatter(logging.Formatter):
+    """Render a log record as a single-line JSON object"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "timestamp": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in STRUCTURED_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                payload[field] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            payload["exception"] = record.exc_text
+        return json.dumps(payload, default=str)
+
+class CategoryRateLimitFilter(logging.Filter):
+    """Token-bucket rate cap per log category.
+
+    The number of records dropped since the last accepted one is attached to
+    the next accepted record as ``suppressed`` so the volume stays visible.
+    """
+
+    def __init__(self, limits: Dict[str, Tuple[float, int]], clock=time.monotonic):
+        super().__init__()
+        self.limits = dict(limits)
+        self.clock = clock
+        self._buckets: Dict[str, list] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        category = getattr(record, "category", None)
+        if category is None or category not in self.limits:
+            return True
+
+        rate, burst = self.limits[category]
+        now = self.clock()
+        with self._lock:
+            bucket = self._buckets.get(category)
+            if bucket is None:
+                # [tokens, last refill time, suppressed since last accepted record]
+                bucket = self._buckets[category] = [float(burst), now, 0]
+            bucket[0] = min(float(burst), bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            if bucket[0] < 1.0:
+                bucket[2] += 1
+                return False
+            bucket[0] -= 1.0
+            if bucket[2]:
+                record.suppressed = bucket[2]
+                bucket[2] = 0
+        return True
+
+class NonBlockingQueueHandler(QueueHandler):
+    """QueueHandler that defers formatting to the listener and never blocks.
+
+    ``QueueHandler.prepare`` normally formats the message on the calling
+    thread; here the record is passed through as-is and the listener's
+    formatter does the work. When the queue is full the record is dropped;
+    the number dropped since the last queued record is attached to the next
+    one as ``queue_dropped``, and ``dropped`` keeps the running total.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._pending_dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        if self._pending_dropped:
+            record.queue_dropped = self._pending_dropped
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            self._pending_dropped += 1
+            return
+        self._pending_dropped = 0
+
+_listener: Optional[QueueListener] = None
+_queue_handler: Optional[NonBlockingQueueHandler] = None
+
+def configure_logging(level: int = logging.INFO,
+                      category_limits: Optional[Dict[str, Tuple[float, int]]] = None,
+                      queue_size: int = DEFAULT_QUEUE_SIZE,
+                      stream=None) -> QueueListener:
+    """Route root logging through a bounded queue to a JSON stream writer.
+
+    Safe to call more than once; the previous listener is stopped first.
+    """
+    global _listener, _queue_handler
+
+    if _listener is not None:
+        _listener.stop()
+
+    log_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(CategoryRateLimitFilter(
+        category_limits if category_limits is not None else DEFAULT_CATEGORY_LIMITS
+    ))
+
+    stream_handler = logging.StreamHandler(stream or sys.stderr)
+    stream_handler.setFormatter(JsonFormatter())
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if isinstance(handler, NonBlockingQueueHandler):
+            root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    _queue_handler = queue_handler
+    root.setLevel(level)
+
+    _listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+def shutdown_logging() -> None:
+    """Flush queued records and stop the listener thread"""
+    global _listener
+
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+atexit.register(shutdown_logging)
+
+def dropped_records() -> int:
+    """Total records dropped because the log queue was full"""
+    return _queue_handler.dropped if _queue_handler is not None else 0
+
+def level_from_env(default: str = "INFO") -> int:
+    """Read the log level from the LOG_LEVEL environment variable"""
+    return getattr(logging, os.getenv("LOG_LEVEL", default).upper(), logging.INFO)
@@ -1,9 +1,19 @@
 import pytest
 import asyncio
 from fastapi.testclient import TestClient
-from unittest.mock import patch
+from unittest.mock import AsyncMock, patch
+from starlette.websockets import WebSocketDisconnect
+import app as app_module
 from app import app
-from auth import AuthenticatedUser
+from auth import AuthenticatedUser, verify_token
+import json
+import logging
+import queue
+import threading
+import time
+from profiling import NULL_TIMER, Profiler
+from presence import PresenceTracker, TimerWheel
+from structured_logging import CategoryRateLimitFilter, JsonFormatter, NonBlockingQueueHandler, log_fields
 
 # Test client
 client = TestClient(app)
@@ -109,6 +119,7 @@ class TestHealthCheck:
         assert data["status"] == "healthy"
         assert "active_rooms" in data
         assert "active_connections" in data
+        assert "log_records_dropped" in data
 
 class TestAuthentication:
     
@@ -121,6 +132,386 @@ class TestAuthentication:
         """Test that joining room requires authentication"""
         response = client.post("/api/join-room", json={"room_code": "TEST12"})
         assert response.status_code == 403  # No auth header
+    
+    def test_profiling_without_auth(self):
+        """Test that profiling endpoints require authentication"""
+        response = client.post("/api/admin/profiling", json={})
+        # Missing credentials: 403 on older FastAPI, 401 since HTTPBearer started sending WWW-Authenticate
+        assert response.status_code in (401, 403)
+        assert not app_module.profiler.active
+
+class StalledWebSocket:
+    """Fake socket whose sends never complete, like a peer that stopped reading"""
+    
+    def __init__(self):
+        self.close_code = None
+    
+    async def send_text(self, text):
+        await asyncio.sleep(3600)
+    
+    async def close(self, code=1000, reason=None):
+        self.close_code = code
+
+class RecordingWebSocket:
+    """Fake socket that records what was sent to it"""
+    
+    def __init__(self):
+        self.sent = []
+    
+    async def send_text(self, text):
+        self.sent.append(json.loads(text))
+
+class TestWebSocketPresence:
+    
+    users = {
+        "interviewer_token": AuthenticatedUser("interviewer_1", "lead@example.com", {"name": "Lead"}),
+        "guest_token": AuthenticatedUser("guest_1", "guest@example.com", {"name": "Guest"}),
+    }
+    
+    def _create_room(self):
+        response = client.post("/api/create-room", json={}, headers={"Authorization": "Bearer mock_token"})
+        room_code = response.json()["room_code"]
+        app_module.interview_rooms[room_code]["interviewer"]["id"] = "interviewer_1"
+        return room_code
+    
+    def _authenticate(self, token):
+        return self.users[token]
+    
+    def _join(self, websocket, token):
+        """Send the auth frame and return the room_state reply"""
+        websocket.send_json({"type": "auth", "token": token})
+        return websocket.receive_json()
+    
+    def test_connection_requires_auth_frame(self):
+        """Test that a WebSocket whose first frame is not an auth message is rejected"""
+        room_code = self._create_room()
+        with pytest.raises(WebSocketDisconnect) as exc_info:
+            with client.websocket_connect(f"/ws/{room_code}") as websocket:
+                websocket.send_json({"type": "editor_update", "content": "x"})
+                websocket.receive_json()
+        assert exc_info.value.code == 4001
+    
+    def test_room_state_includes_roster(self):
+        """Test that room_state carries the connection id and filled-in participants"""
+        room_code = self._create_room()
+        with patch("app.authenticate_token", new=AsyncMock(side_effect=self._authenticate)):
+            with client.websocket_connect(f"/ws/{room_code}") as websocket:
+                state = self._join(websocket, "interviewer_token")
+        
+        assert state["type"] == "room_state"
+        participants = state["room_info"]["participants"]
+        assert [p["connection_id"] for p in participants] == [state["connection_id"]]
+        assert participants[0]["user_id"] == "interviewer_1"
+        assert participants[0]["role"] == "interviewer"
+    
+    def test_join_and_leave_send_presence_diffs(self):
+        """Test that other participants see added/removed diffs and the roster empties"""
+        room_code = self._create_room()
+        with patch("app.authenticate_token", new=AsyncMock(side_effect=self._authenticate)):
+            with client.websocket_connect(f"/ws/{room_code}") as first:
+                self._join(first, "interviewer_token")
+                
+                with client.websocket_connect(f"/ws/{room_code}") as second:
+                    second_id = self._join(second, "guest_token")["connection_id"]
+                    added = first.receive_json()
+                    assert added["type"] == "presence_diff"
+                    assert added["added"][0]["connection_id"] == second_id
+                    assert added["added"][0]["role"] == "observer"
+                    
+                    # Close explicitly so the server finishes its cleanup before the session is torn down
+                    second.close()
+                    removed = first.receive_json()
+                    assert removed["type"] == "presence_diff"
+                    assert removed["removed"] == [second_id]
+        
+        response = client.get(f"/api/room/{room_code}")
+        assert response.json()["participants"] == []
+    
+    def test_monitoring_logs_use_verified_user_id(self, caplog):
+        """Test that structured monitoring logs carry the token's user id, not the client's"""
+        room_code = self._create_room()
+        with patch("app.authenticate_token", new=AsyncMock(side_effect=self._authenticate)):
+            with client.websocket_connect(f"/ws/{room_code}") as first:
+                self._join(first, "interviewer_token")
+                with client.websocket_connect(f"/ws/{room_code}") as second:
+                    self._join(second, "guest_token")
+                    first.receive_json()
+                    
+                    with caplog.at_level(logging.INFO):
+                        second.send_json({"type": "window_focus_lost", "user_id": "spoofed", "user_name": "Spoof"})
+                        # The follow-up broadcast arrives only after the focus-loss handler has logged
+                        second.send_json({"type": "cursor_update", "user_id": "spoofed"})
+                        assert first.receive_json()["type"] == "candidate_monitoring_alert"
+                        assert first.receive_json()["type"] == "cursor_update"
+                    
+                    second.close()
+                    first.receive_json()
+        
+        records = [r for r in caplog.records if getattr(r, "message_type", None) == "window_focus_lost"]
+        assert [r.user_id for r in records] == ["guest_1"]
+    
+    def test_pong_updates_rtt(self):
+        """Test that a pong for the current ping sets rtt_ms from the clock and restores quality"""
+        now = [100.0]
+        tracker = PresenceTracker(clock=lambda: now[0])
+        room_code = self._create_room()
+        with patch.object(app_module, "presence", tracker), \
+                patch("app.authenticate_token", new=AsyncMock(side_effect=self._authenticate)):
+            with client.websocket_connect(f"/ws/{room_code}") as websocket:
+                connection_id = self._join(websocket, "interviewer_token")["connection_id"]
+                
+                # Miss two heartbeats so the pong changes quality and is broadcast
+                tracker.next_ping()
+                tracker.next_ping()
+                seq, _ = tracker.next_ping()
+                now[0] += 0.08
+                websocket.send_json({"type": "pong", "seq": seq})
+                
+                diff = websocket.receive_json()
+        
+        assert diff["type"] == "presence_diff"
+        assert diff["updated"] == [{"connection_id": connection_id, "quality": "good", "rtt_ms": 80.0}]
+    
+    def test_stalled_peer_is_closed_by_broadcast(self):
+        """Test that a peer whose send times out is closed, not left as an untracked zombie"""
+        stalled = StalledWebSocket()
+        healthy = RecordingWebSocket()
+        tracker = PresenceTracker()
+        tracker.join("STALL1", stalled, "u1", "Stalled", "candidate")
+        tracker.join("STALL1", healthy, "u2", "Healthy", "interviewer")
+        
+        with patch.object(app_module, "presence", tracker), \
+                patch.object(app_module, "HEARTBEAT_SEND_TIMEOUT", 0.05), \
+                patch.dict(app_module.active_connections, {"STALL1": [stalled, healthy]}):
+            asyncio.run(app_module.broadcast_to_room("STALL1", {"type": "cursor_update"}))
+            
+            assert stalled.close_code == 4008
+            assert app_module.active_connections["STALL1"] == [healthy]
+            assert tracker.get(stalled) is None
+        
+        assert [message["type"] for message in healthy.sent] == ["cursor_update", "presence_diff"]
+
+class TestAdminProfiling:
+    
+    admin = AuthenticatedUser("admin_1", "admin@example.com", {"name": "Admin"})
+    member = AuthenticatedUser("member_1", "member@example.com", {"name": "Member", "role": "admin"})
+    
+    def _as_user(self, user):
+        app.dependency_overrides[verify_token] = lambda: user
+    
+    def teardown_method(self):
+        app.dependency_overrides.pop(verify_token, None)
+        app_module.profiler.stop()
+    
+    @patch("auth.ADMIN_EMAILS", {"admin@example.com"})
+    def test_non_admin_is_forbidden(self):
+        """Test that a signed-in non-admin (even with a self-set user_metadata role) gets 403"""
+        self._as_user(self.member)
+        headers = {"Authorization": "Bearer mock_token"}
+        
+        assert client.post("/api/admin/profiling", json={}, headers=headers).status_code == 403
+        assert client.get("/api/admin/profiling", headers=headers).status_code == 403
+        assert client.delete("/api/admin/profiling", headers=headers).status_code == 403
+        assert client.get("/api/admin/profiling/flamegraph", headers=headers).status_code == 403
+        assert not app_module.profiler.active
+    
+    @patch("auth.ADMIN_EMAILS", {"admin@example.com"})
+    def test_admin_can_profile(self):
+        """Test that a user listed in ADMIN_EMAILS can run a profiling window"""
+        self._as_user(self.admin)
+        headers = {"Authorization": "Bearer mock_token"}
+        
+        response = client.post("/api/admin/profiling", json={"duration_seconds": 5}, headers=headers)
+        assert response.status_code == 200
+        assert client.post("/api/admin/profiling", json={}, headers=headers).status_code == 409
+        
+        assert client.get("/api/admin/profiling", headers=headers).status_code == 200
+        
+        response = client.get("/api/admin/profiling/flamegraph", headers=headers)
+        assert response.status_code == 200
+        assert "attachment" in response.headers["content-disposition"]
+        
+        assert client.delete("/api/admin/profiling", headers=headers).status_code == 200
+        assert app_module.profiler.wait(timeout=5)
+        assert not app_module.profiler.active
+    
+    def test_app_metadata_role_grants_admin(self):
+        """Test that the service-role-only app_metadata role is honoured"""
+        self._as_user(AuthenticatedUser("ops_1", "ops@example.com", {}, {"role": "admin"}))
+        response = client.get("/api/admin/profiling", headers={"Authorization": "Bearer mock_token"})
+        assert response.status_code == 200
+
+class TestProfiling:
+    
+    def test_timer_is_noop_when_inactive(self):
+        """Test that handlers get the shared no-op timer outside a window"""
+        profiler = Profiler()
+        timer = profiler.timer("ROOM01")
+        timer.mark("editor_update", "parse")
+        
+        assert timer is NULL_TIMER
+        assert profiler.report()["handlers"] == {}
+    
+    def test_phase_timings_and_slow_awaits(self):
+        """Test per-message-type aggregation and the slow await threshold"""
+        profiler = Profiler()
+        profiler.slow_threshold = 0.1
+        profiler.record("ROOM01", "editor_update", "broadcast", 0.02)
+        profiler.record("ROOM01", "editor_update", "broadcast", 0.25)
+        
+        report = profiler.report()
+        stats = report["handlers"]["editor_update"]["broadcast"]
+        assert stats["count"] == 2
+        assert stats["max_ms"] == 250.0
+        assert len(report["slow_awaits"]) == 1
+        assert report["slow_awaits"][0]["phase"] == "broadcast"
+    
+    def test_sampler_produces_folded_stacks(self):
+        """Test that the sampling window collects collapsed stacks and then closes"""
+        profiler = Profiler()
+        worker_id = []
+        done = threading.Event()
+        
+        def busy():
+            worker_id.append(threading.get_ident())
+            while not done.is_set():
+                sum(range(1000))
+        
+        worker = threading.Thread(target=busy)
+        worker.start()
+        while not worker_id:
+            time.sleep(0.001)
+        try:
+            profiler.start(duration=0.2, sample_interval=0.005, slow_threshold=1.0, thread_id=worker_id[0])
+            assert profiler.active
+            assert profiler.wait(timeout=5)
+        finally:
+            done.set()
+            worker.join()
+        
+        assert not profiler.active
+        assert profiler.samples > 0
+        lines = profiler.folded_stacks().splitlines()
+        assert any("busy" in line for line in lines)
+        assert all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+
+class TestPresence:
+    
+    def test_timer_wheel_expires_after_delay(self):
+        """Test that keys expire on the right tick and rescheduling moves them"""
+        wheel = TimerWheel(tick=1.0, horizon=3.0)
+        wheel.schedule("a", 3.0)
+        wheel.schedule("b", 2.0)
+        
+        assert wheel.advance() == set()
+        assert wheel.advance() == set()
+        assert wheel.advance() == {"b"}
+        
+        # Rescheduling mid-tick never expires before the full delay has passed
+        wheel.schedule("a", 3.0)
+        assert wheel.advance() == set()
+        assert wheel.advance() == set()
+        assert wheel.advance() == set()
+        assert wheel.advance() == {"a"}
+        assert len(wheel) == 0
+    
+    def test_silent_connection_is_reaped_within_timeout(self):
+        """Test that only sockets without recent traffic are reaped"""
+        tracker = PresenceTracker(timeout=3.0, tick=1.0)
+        tracker.join("ROOM01", "alive", "u1", "Alice", "interviewer")
+        tracker.join("ROOM01", "dead", "u2", "Bob", "candidate")
+        
+        reaped = []
+        for _ in range(5):
+            tracker.touch("alive")
+            reaped.extend(tracker.expire())
+        
+        assert reaped == ["dead"]
+        assert tracker.leave("dead")[1]["user_name"] == "Bob"
+        assert tracker.leave("dead") is None
+    
+    def test_missed_pongs_degrade_quality(self):
+        """Test that unanswered pings produce quality diffs and a pong restores them"""
+        now = [0.0]
+        tracker = PresenceTracker(timeout=30.0, tick=1.0, clock=lambda: now[0])
+        entry = tracker.join("ROOM01", "ws", "u1", "Alice", "candidate")
+        
+        tracker.next_ping()
+        _, updates = tracker.next_ping()
+        assert updates["ROOM01"][0]["quality"] == "fair"
+        _, updates = tracker.next_ping()
+        assert updates["ROOM01"][0]["quality"] == "poor"
+        
+        seq, _ = tracker.next_ping()
+        now[0] += 0.05
+        room_code, update = tracker.pong("ws", seq)
+        assert room_code == "ROOM01"
+        assert update["quality"] == "good"
+        assert entry["rtt_ms"] == 50.0
+
+class TestStructuredLogging:
+    
+    def _record(self, msg="hello %s", args=("world",), **extra):
+        record = logging.LogRecord("test", logging.INFO, __file__, 1, msg, args, None)
+        for key, value in extra.items():
+            setattr(record, key, value)
+        return record
+    
+    def test_json_formatter_includes_structured_fields(self):
+        """Test that JSON records carry room, user and message type"""
+        record = self._record(**log_fields("monitoring", room_code="ABC123", user_id="u1",
+                                           message_type="window_focus_lost"))
+        data = json.loads(JsonFormatter().format(record))
+        
+        assert data["message"] == "hello world"
+        assert data["room_code"] == "ABC123"
+        assert data["user_id"] == "u1"
+        assert data["message_type"] == "window_focus_lost"
+        assert data["category"] == "monitoring"
+    
+    def test_rate_limit_filter_caps_category(self):
+        """Test that a category is capped and suppressed records are counted"""
+        now = [0.0]
+        limiter = CategoryRateLimitFilter({"monitoring": (1.0, 2)}, clock=lambda: now[0])
+        
+        results = [limiter.filter(self._record(category="monitoring")) for _ in range(5)]
+        assert results == [True, True, False, False, False]
+        
+        # Uncategorised records are never sampled
+        assert limiter.filter(self._record())
+        
+        now[0] = 1.0
+        record = self._record(category="monitoring")
+        assert limiter.filter(record)
+        assert record.suppressed == 3
+    
+    def test_queue_handler_defers_formatting_and_drops_when_full(self):
+        """Test that the queue handler never formats or blocks on the caller"""
+        handler = NonBlockingQueueHandler(queue.Queue(maxsize=1))
+        record = self._record()
+        
+        handler.handle(record)
+        handler.handle(self._record())
+        
+        assert handler.queue.get_nowait() is record
+        assert record.msg == "hello %s"
+        assert handler.dropped == 1
+    
+    def test_queue_handler_reports_dropped_records_on_next_record(self):
+        """Test that records lost to a full queue are counted on the next queued one"""
+        handler = NonBlockingQueueHandler(queue.Queue(maxsize=1))
+        handler.handle(self._record())
+        handler.handle(self._record())
+        handler.handle(self._record())
+        handler.queue.get_nowait()
+        
+        record = self._record()
+        handler.handle(record)
+        
+        assert record.queue_dropped == 2
+        assert handler.dropped == 2
+        data = json.loads(JsonFormatter().format(handler.queue.get_nowait()))
+        assert data["queue_dropped"] == 2
 
 if __name__ == "__main__":
     pytest.main([__file__, "-v"]) 
\ No newline at end of file
@@ -109,12 +109,8 @@ const CollaborativeRoom: React.FC<CollaborativeRoomProps> = ({ roomCode, isInter
         }
         break;
         
-      case 'participant_joined':
-        console.log('Participant joined');
-        break;
-        
-      case 'participant_left':
-        console.log('Participant left');
+      case 'presence_diff':
+        console.log('Presence changed:', data);
         break;
         
       case 'room_closed':
@@ -172,8 +168,8 @@ const CollaborativeRoom: React.FC<CollaborativeRoomProps> = ({ roomCode, isInter
           }
         );
 
-        ws.connect();
         wsRef.current = ws;
+        await ws.connect();
         
       } catch (error) {
         console.error('Failed to initialize room:', error);
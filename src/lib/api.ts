@@ -141,11 +141,14 @@ export class CollaborativeWebSocket {
     this.onError = callbacks.onError;
   }
 
-  connect(): void {
+  async connect(): Promise<void> {
     const wsUrl = API_BASE_URL.replace('http://', 'ws://').replace('https://', 'wss://');
+    const token = await getAuthToken();
     this.ws = new WebSocket(`${wsUrl}/ws/${this.roomCode}`);
 
     this.ws.onopen = () => {
+      // Authenticate in the first frame so the JWT never appears in a URL or access log
+      this.ws?.send(JSON.stringify({ type: 'auth', token }));
       console.log(`Connected to room ${this.roomCode}`);
       this.onOpen();
     };
@@ -153,6 +156,11 @@ export class CollaborativeWebSocket {
     this.ws.onmessage = (event) => {
       try {
         const data = JSON.parse(event.data);
+        // Answer server heartbeats so the connection is not reaped
+        if (data.type === 'ping') {
+          this.ws?.send(JSON.stringify({ type: 'pong', seq: data.seq }));
+          return;
+        }
         this.onMessage(data);
       } catch (error) {
         console.error('Failed to parse WebSocket message:', error);